@@ -0,0 +1,74 @@
+# micro-benchmark: GET /videos response_model path vs the ?fast=1 path
+# run from the repo root: python -m backend.bench_serialization
+
+import os
+import json
+import time
+import datetime
+
+os.environ.setdefault("SECRET_KEY", "bench")
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from pydantic import TypeAdapter
+
+from . import models, schemas, serializers
+
+
+def build_session(rows: int):
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    db.add(models.User(id=1, email="bench@example.com", hashed_password="x"))
+    now = datetime.datetime.now(datetime.timezone.utc)
+    db.add_all(
+        models.VideoGeneration(prompt=f"prompt {i} " * 8, status="Completed", user_id=1,
+                               created_at=now - datetime.timedelta(minutes=i))
+        for i in range(rows)
+    )
+    db.commit()
+    return db
+
+
+def response_model_path(db, adapter):
+    # what FastAPI does for response_model=list[VideoResponse]: validate from attributes,
+    # dump in json mode, then JSONResponse's json.dumps
+    videos = db.query(models.VideoGeneration).filter(
+        models.VideoGeneration.user_id == 1
+    ).order_by(models.VideoGeneration.created_at.desc()).all()
+    content = adapter.dump_python(adapter.validate_python(videos, from_attributes=True), mode="json")
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+def fast_path(db, adapter):
+    rows = db.query(*serializers.VIDEO_COLUMNS).filter(
+        models.VideoGeneration.user_id == 1
+    ).order_by(models.VideoGeneration.created_at.desc()).all()
+    return serializers.dumps(serializers.video_rows(rows, 1))
+
+
+def bench(fn, db, adapter, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        db.expunge_all()
+        started = time.perf_counter()
+        fn(db, adapter)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    adapter = TypeAdapter(list[schemas.VideoResponse])
+    encoder = "orjson" if serializers.orjson is not None else "json"
+    for rows in (1_000, 10_000):
+        db = build_session(rows)
+        assert json.loads(response_model_path(db, adapter)) == json.loads(fast_path(db, adapter))
+        slow = bench(response_model_path, db, adapter, repeat=5)
+        fast = bench(fast_path, db, adapter, repeat=5)
+        print(f"{rows:>6} rows  response_model {slow * 1000:8.1f} ms  "
+              f"fast ({encoder}) {fast * 1000:8.1f} ms  x{slow / fast:.1f}")
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+# background job runner for video generations, kept out of the request thread pool:
+#
+# - one dispatcher thread submits "queued" jobs (args in video_submissions) whenever a
+#   deployment can take them; upstream trouble puts the job back in the queue with backoff
+# - one poller thread hands due "processing" jobs to a small dedicated executor
+# - at startup and every minute, jobs no runner can finish any more are failed
+#
+# All state lives in the database and every hand-off is a conditional UPDATE, so several
+# processes can run a runner side by side and a restart simply picks the work up again.
+
+import os
+import time
+import threading
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import func
+
+from . import models, database, videogen, upstream
+
+
+POLL_INTERVAL_SECONDS = float(os.getenv("POLL_INTERVAL_SECONDS", "5"))
+# a claimed poll that hasn't finished after this long may be picked up again
+POLL_LEASE_SECONDS = float(os.getenv("POLL_LEASE_SECONDS", "120"))
+POLL_WORKERS = int(os.getenv("POLL_WORKERS", "8"))
+MAX_POLL_ERRORS = 10
+DISPATCH_BATCH_SIZE = 20
+# how often the runner threads look for new work when nobody wakes them
+IDLE_SECONDS = 1.0
+# unfinished jobs nobody can complete any more are failed this often (and at startup)
+REAP_INTERVAL_SECONDS = 60
+# an upstream job still running this long after submission is given up on
+JOB_TIMEOUT_SECONDS = float(os.getenv("JOB_TIMEOUT_SECONDS", str(6 * 3600)))
+# a job that couldn't be submitted for this long (e.g. a long outage) fails; 0 waits forever
+QUEUE_TIMEOUT_SECONDS = float(os.getenv("QUEUE_TIMEOUT_SECONDS", str(24 * 3600)))
+
+# statuses whose jobs hold a deployment slot
+ACTIVE_STATUSES = ("submitting", "processing")
+
+
+def _utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _later(seconds: float):
+    return _utcnow() + datetime.timedelta(seconds=seconds)
+
+
+def active_counts(db) -> dict:
+    rows = db.query(models.VideoGeneration.deployment, func.count()).filter(
+        models.VideoGeneration.status.in_(ACTIVE_STATUSES)
+    ).group_by(models.VideoGeneration.deployment).all()
+    counts = {}
+    for name, count in rows:
+        # "submitting" rows have no deployment yet when claimed by an older process
+        name = videogen.pool.get(name).name
+        counts[name] = counts.get(name, 0) + count
+    return counts
+
+
+def _claim(db, video_id: int, from_status: str, values: dict) -> bool:
+    if "status" in values:
+        # a bulk update skips the flush hook, so stamp the change for delta-sync clients here
+        values = {**values, "change_seq": models.next_sequence(db, "video_changes")}
+    claimed = db.query(models.VideoGeneration).filter(
+        models.VideoGeneration.id == video_id,
+        models.VideoGeneration.status == from_status
+    ).update(values, synchronize_session=False)
+    db.commit()
+    return claimed == 1
+
+
+def dispatch_once() -> float:
+    """Submit due queued jobs. Returns how long the dispatcher may sleep."""
+    db = database.SessionLocal()
+    try:
+        due = db.query(models.VideoSubmission, models.VideoGeneration).join(
+            models.VideoGeneration, models.VideoGeneration.id == models.VideoSubmission.video_id
+        ).filter(
+            models.VideoGeneration.status == "queued",
+            models.VideoSubmission.next_attempt_at <= _utcnow()
+        ).order_by(models.VideoSubmission.video_id).limit(DISPATCH_BATCH_SIZE).all()
+        if not due:
+            return IDLE_SECONDS
+
+        videogen.pool.set_in_flight(active_counts(db))
+        for submission, video in due:
+            try:
+                deployment = videogen.pool.acquire()
+            except upstream.NoDeploymentAvailable as e:
+                # nothing can take work right now; everything stays queued
+                return min(e.retry_after, IDLE_SECONDS * 5)
+
+            if not _claim(db, video.id, "queued", {"status": "submitting", "deployment": deployment.name,
+                                                     "next_poll_at": _later(POLL_LEASE_SECONDS)}):
+                continue  # cancelled, or another process took it
+            submit(db, submission, video.id, video.prompt, deployment)
+        return 0
+    finally:
+        db.close()
+
+
+def submit(db, submission: models.VideoSubmission, video_id: int, prompt: str, deployment):
+    try:
+        initial_response = videogen.request_video(prompt, submission.size_str, submission.sec,
+                                                  submission.image, deployment=deployment)
+    except upstream.UpstreamError as e:
+        if e.retryable:
+            # the upstream never took the job: back to the queue, with backoff
+            submission.attempts += 1
+            submission.next_attempt_at = _later(upstream.backoff_delay(submission.attempts, e.retry_after))
+            db.commit()
+            _claim(db, video_id, "submitting", {"status": "queued", "deployment": None})
+            # give back the slot acquire() counted, or the pool looks busier than it is
+            videogen.pool.set_in_flight(active_counts(db))
+            return
+        print(f"Submission of video {video_id} rejected: {e}")
+        _finish_submission(db, submission, video_id, {"status": "failed"})
+        return
+    except Exception as e:
+        print(f"Submission of video {video_id} failed: {e}")
+        _finish_submission(db, submission, video_id, {"status": "failed"})
+        return
+
+    job_id = initial_response.get("id")
+    if not _finish_submission(db, submission, video_id, {
+            "status": "processing", "job_id": job_id, "submitted_at": _utcnow(),
+            "next_poll_at": _later(POLL_INTERVAL_SECONDS), "poll_errors": 0}):
+        # cancelled while we were submitting
+        videogen.cancel_generation(job_id, deployment)
+
+
+def _finish_submission(db, submission, video_id: int, values: dict) -> bool:
+    db.delete(submission)
+    db.commit()
+    record = db.query(models.VideoGeneration).filter(
+        models.VideoGeneration.id == video_id).populate_existing().first()
+    # through the ORM so the change-sequence and usage flush hooks see the status change
+    if record is None or record.status != "submitting":
+        return False
+    for name, value in values.items():
+        setattr(record, name, value)
+    db.commit()
+    return True
+
+
+def claim_due_polls(db) -> list:
+    now = _utcnow()
+    due = [row.id for row in db.query(models.VideoGeneration.id).filter(
+        models.VideoGeneration.status == "processing",
+        models.VideoGeneration.job_id.isnot(None),
+        models.VideoGeneration.next_poll_at <= now
+    ).order_by(models.VideoGeneration.next_poll_at).limit(POLL_WORKERS * 4)]
+    claimed = []
+    for video_id in due:
+        taken = db.query(models.VideoGeneration).filter(
+            models.VideoGeneration.id == video_id,
+            models.VideoGeneration.status == "processing",
+            models.VideoGeneration.next_poll_at <= now
+        ).update({"next_poll_at": _later(POLL_LEASE_SECONDS)}, synchronize_session=False)
+        if taken:
+            claimed.append(video_id)
+    db.commit()
+    return claimed
+
+
+def poll_job(video_id: int):
+    # Polling errors back off exponentially (or by the upstream's Retry-After) and
+    # the job is given up after MAX_POLL_ERRORS in a row. Retries of individual calls
+    # are already limited by the shared retry budget in videogen.
+    db = database.SessionLocal()
+    try:
+        record = db.query(models.VideoGeneration).filter(models.VideoGeneration.id == video_id).first()
+        if record is None or record.status != "processing":
+            return
+        deployment = videogen.pool.get(record.deployment)
+        try:
+            status_data = videogen.get_generation_status(record.job_id, deployment)
+            if not status_data:
+                raise upstream.UpstreamError("Failed to get status data")
+        except upstream.CircuitOpenError as open_error:
+            # not this job's fault, wait for the breaker's half-open probe
+            _update_poll(db, video_id, {"next_poll_at": _later(open_error.retry_after)})
+            return
+        except Exception as poll_error:
+            print(f"Polling error: {poll_error}")
+            errors = (record.poll_errors or 0) + 1
+            if errors >= MAX_POLL_ERRORS:
+                _update_poll(db, video_id, {"status": "failed", "poll_errors": errors})
+            else:
+                delay = max(POLL_INTERVAL_SECONDS,
+                            upstream.backoff_delay(errors, getattr(poll_error, "retry_after", None)))
+                _update_poll(db, video_id, {"poll_errors": errors, "next_poll_at": _later(delay)})
+            return
+
+        status = status_data.get("status")
+        generations = status_data.get("generations", [])
+        if status == "succeeded" and generations:
+            generation_id = generations[0].get("id")
+            video_url = videogen.get_generation_video_url(generation_id, deployment)
+            clean_url = video_url.split('?')[0]
+            _update_poll(db, video_id, {"video_url": clean_url, "status": "Completed"})
+        elif status == "failed":
+            _update_poll(db, video_id, {"status": "Failed"})
+        else:
+            _update_poll(db, video_id, {"poll_errors": 0, "next_poll_at": _later(POLL_INTERVAL_SECONDS)})
+    finally:
+        db.close()
+
+
+def _update_poll(db, video_id: int, values: dict):
+    record = db.query(models.VideoGeneration).filter(
+        models.VideoGeneration.id == video_id).populate_existing().first()
+    # a job cancelled while we were polling keeps its status
+    if record is None or record.status != "processing":
+        return
+    for name, value in values.items():
+        setattr(record, name, value)
+    db.commit()
+
+
+def reap_stale(db) -> list:
+    """Fail unfinished jobs that no runner will ever finish, so they stop counting
+    against the in-flight quota. Returns the (job_id, deployment) pairs of the timed out
+    upstream jobs, which the caller should cancel."""
+    now = _utcnow()
+    video = models.VideoGeneration
+    has_submission = db.query(models.VideoSubmission.video_id).filter(
+        models.VideoSubmission.video_id == video.id).exists()
+    # rows submitted before submitted_at existed fall back to their creation time
+    submitted_at = func.coalesce(video.submitted_at, video.created_at)
+    stale = (
+        # a submitter that died mid-request: its lease ran out and the upstream job id is lost
+        ((video.status == "submitting") & (video.next_poll_at < now))
+        # rows from the old in-process poller, which never recorded the job id
+        | ((video.status == "processing") & video.job_id.is_(None))
+        | ((video.status == "queued") & ~has_submission)
+        | ((video.status == "processing") & (submitted_at < now - datetime.timedelta(seconds=JOB_TIMEOUT_SECONDS)))
+    )
+    if QUEUE_TIMEOUT_SECONDS > 0:
+        stale = stale | ((video.status == "queued")
+                         & (video.created_at < now - datetime.timedelta(seconds=QUEUE_TIMEOUT_SECONDS)))
+    stale = db.query(video.id).filter(stale).all()
+
+    timed_out = []
+    for (video_id,) in stale:
+        record = db.query(video).filter(video.id == video_id).populate_existing().first()
+        if record is None or record.status in models.FINISHED_STATUSES:
+            continue
+        print(f"Giving up on video {video_id} ({record.status})")
+        if record.status == "processing" and record.job_id:
+            timed_out.append((record.job_id, record.deployment))
+        # through the ORM so the usage hook releases the in-flight slot
+        record.status = "failed"
+        db.query(models.VideoSubmission).filter(models.VideoSubmission.video_id == video_id).delete()
+        db.commit()
+    return timed_out
+
+
+def cancel_upstream(job_id: str, deployment_name: str):
+    videogen.cancel_generation(job_id, videogen.pool.get(deployment_name))
+
+
+class JobRunner:
+    def __init__(self):
+        self._stop = threading.Event()
+        self._dispatch_wake = threading.Event()
+        self._poll_wake = threading.Event()
+        self._threads = []
+        self._executor = None
+        self._last_reap = 0.0
+
+    def start(self):
+        if self._threads:
+            return
+        self._stop.clear()
+        self._executor = ThreadPoolExecutor(max_workers=POLL_WORKERS, thread_name_prefix="video-poll")
+        # before serving requests, so leftovers of a previous run don't block anyone's quota
+        self._reap()
+        for target, name in ((self._dispatch_loop, "video-dispatch"), (self._poll_loop, "video-poller")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        self._dispatch_wake.set()
+        self._poll_wake.set()
+        for thread in self._threads:
+            thread.join(5)
+        self._threads = []
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def wake(self):
+        # a new submission shouldn't wait for the next idle tick
+        self._dispatch_wake.set()
+
+    def cancel(self, jobs):
+        """Ask the upstream to stop (job_id, deployment name) pairs, off the request thread."""
+        for job_id, deployment_name in jobs:
+            if self._executor:
+                self._executor.submit(cancel_upstream, job_id, deployment_name)
+
+    def _reap(self):
+        self._last_reap = time.monotonic()
+        db = database.SessionLocal()
+        try:
+            self.cancel(reap_stale(db))
+        except Exception as e:
+            print(f"Reaper error: {e}")
+        finally:
+            db.close()
+
+    def _dispatch_loop(self):
+        while not self._stop.is_set():
+            try:
+                delay = dispatch_once()
+            except Exception as e:
+                print(f"Dispatcher error: {e}")
+                delay = IDLE_SECONDS
+            if delay > 0:
+                self._dispatch_wake.wait(delay)
+                self._dispatch_wake.clear()
+
+    def _poll_loop(self):
+        while not self._stop.is_set():
+            if time.monotonic() - self._last_reap >= REAP_INTERVAL_SECONDS:
+                self._reap()
+            db = database.SessionLocal()
+            try:
+                for video_id in claim_due_polls(db):
+                    self._executor.submit(self._poll_and_wake, video_id)
+            except Exception as e:
+                print(f"Poller error: {e}")
+            finally:
+                db.close()
+            self._poll_wake.wait(IDLE_SECONDS)
+            self._poll_wake.clear()
+
+    def _poll_and_wake(self, video_id: int):
+        try:
+            poll_job(video_id)
+        except Exception as e:
+            print(f"Poll of video {video_id} failed: {e}")
+        finally:
+            # a finished job frees a deployment slot for the queue
+            self._dispatch_wake.set()
+
+
+runner = JobRunner()
@@ -1,16 +1,18 @@
-from fastapi import FastAPI, Depends, HTTPException,File, UploadFile, Form
+from fastapi import FastAPI, Depends, HTTPException,File, UploadFile, Form, Response, Request, Query
+from sqlalchemy import text
 from sqlalchemy.orm import Session
 from typing import Optional
+import os
+import time
 import base64
 import requests
 from datetime import timedelta
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
-from . import models, crud, schemas, auth , videogen, database
-from .database import engine, get_database
-from fastapi import BackgroundTasks
+from . import models, crud, schemas, auth , videogen, database, upstream, signing, serializers, usage, retention, jobs
+from .database import get_database
 from fastapi.responses import StreamingResponse
-import time
+from functools import lru_cache
 
 app = FastAPI()
 
@@ -29,7 +31,44 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-models.Base.metadata.create_all(bind=engine)
+def upgrade_database():
+    # brings a database created by an older version up to date; every step is idempotent
+    added = database.ensure_schema()
+    db = database.SessionLocal()
+    try:
+        models.backfill_change_seq(db)
+        if "video_generation_history.video_id" in added["columns"]:
+            # archives written before the column existed used the video id as their own
+            db.execute(text("UPDATE video_generation_history SET video_id = id WHERE video_id IS NULL"))
+            db.commit()
+        if "user_usage" in added["tables"] or added["columns"] & {"video_generations.seconds",
+                                                                 "user_usage.reserved_seconds"}:
+            usage.rebuild(db)
+    finally:
+        db.close()
+
+
+upgrade_database()
+
+
+def _after_compaction(report: dict):
+    # archived videos must stop resolving from the stream memo
+    resolve_stream_url.cache_clear()
+
+
+compaction_scheduler = retention.CompactionScheduler(on_done=_after_compaction)
+
+
+@app.on_event("startup")
+def start_background_workers():
+    jobs.runner.start()
+    compaction_scheduler.start()
+
+
+@app.on_event("shutdown")
+def stop_background_workers():
+    jobs.runner.stop()
+    compaction_scheduler.stop()
 
 
 @app.get("/")
@@ -37,6 +76,18 @@ def root():
     return {"status": "backend running"}
 
 
+@app.get("/health/upstream")
+def upstream_health(response: Response, db: Session = Depends(get_database)):
+    # cached probe, safe to hit from load balancers and readiness checks
+    health = videogen.health.get()
+    # acquire() counts handed-out slots in memory until the next refresh; report the real load
+    videogen.pool.set_in_flight(jobs.active_counts(db))
+    health["pool"] = videogen.pool.snapshot()
+    if not health.get("healthy") or all(d["circuit"] == upstream.CircuitBreaker.OPEN for d in health["pool"]):
+        response.status_code = 503
+    return health
+
+
 @app.post("/signup", response_model=schemas.User)
 def signup(user: schemas.UserCreate, db: Session = Depends(get_database)):
     db_user = crud.get_user_by_email(db, email=user.email)
@@ -73,90 +124,19 @@ def read_users_me(current_user: models.User = Depends(auth.get_current_user)):
     return current_user
 
 
+@app.get("/users/me/usage", response_model=schemas.Usage)
+def read_users_me_usage(
+    days: int = Query(7, ge=1, le=90),
+    db: Session = Depends(get_database),
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    return usage.get_usage(db, current_user.id, days=days)
+
+
 @app.get("/verify")
 def verify_user(token: str, db: Session = Depends(get_database)):
                 return {"message": "Email verified succesfully"}
 
-def get_generation_video_url(generation_id: str):
-
-    # FIX: Corrected video URL construction by removing '/jobs' from the endpoint
-    # Previously was creating invalid URLs like .../jobs/video/generations/...
-    # Now creates proper URLs: .../openai/v1/video/generations/{id}/content/video
-
-    base_url = videogen.SORA_ENDPOINT.split('/jobs')[0]
-    url = f"{base_url}/{generation_id}/content/video?api-version=preview&api-key={videogen.SORA_KEY}"
-    return url
-
-
-def run_azure(video_id:int , prompt:str,size_str:str,sec:str,image:str = None):
-    db = database.SessionLocal()
-    try:
-            initial_response = videogen.request_video(prompt,size_str,sec,image)
-            job_id = initial_response.get("id")
-            
-
-            # FIX: Added retry logic to handle temporary network connection issues
-            # Tracks consecutive errors and allows up to 10 retries before giving up
-            # This prevents the entire video generation from failing due to brief network hiccups
-
-            consecutive_errors = 0
-            max_consecutive_errors = 10
-
-            while True:
-                try:
-                    status_data = videogen.get_generation_status(job_id)
-                    consecutive_errors = 0 # Reset on success
-
-                    if not status_data:
-                        raise Exception("Failed to get status data")
-                    status = status_data.get("status")
-
-                    video_record = db.query(models.VideoGeneration).filter(models.VideoGeneration.id==video_id).first()
-
-                    if status == "succeeded":
-                        generations = status_data.get("generations", [])
-                        if generations:
-                            generation_id = generations[0].get("id")
-                            video_url = get_generation_video_url(generation_id)
-                            clean_url = video_url.split('?')[0]
-                            video_record.video_url = clean_url
-                            video_record.status = "Completed"
-                            db.commit()
-                            break
-
-                    elif status == "failed":
-                    
-                        video_record.status = "Failed"
-                        db.commit()
-                        break
-                    else:
-                        
-                        import time
-                        time.sleep(5)  
-
-                # FIX: Catch network errors during polling and retry instead of crashing
-                # Waits 5 seconds between retries to avoid overwhelming the server
-                # Only gives up after 10 consecutive failures (about 50 seconds of downtime)
-
-                except Exception as poll_error:
-                    print(f"Polling error: {poll_error}")
-                    consecutive_errors += 1
-                    if consecutive_errors >= max_consecutive_errors:
-                        raise poll_error
-                    import time
-                    time.sleep(5)
-                    
-                   
-    except Exception as e:
-            print(f"background task error: {e}")
-            video_record = db.query(models.VideoGeneration).filter(models.VideoGeneration.id==video_id).first()
-            if video_record:
-                video_record.status ="failed"
-                db.commit()
-    finally:
-          db.close()
-
-
 def video_create_as_form(
     prompt: str = Form(...),
     size_str: str = Form("1080x1080"),
@@ -166,8 +146,15 @@ def video_create_as_form(
 
 
 
+def parse_seconds(sec: str) -> int:
+    try:
+        return max(0, int(float(sec)))
+    except (TypeError, ValueError):
+        return 0
+
+
 @app.post("/generate", response_model=schemas.VideoResponse)
-async def generate_video(background_tasks: BackgroundTasks,
+async def generate_video(
                    video_in:schemas.VideoCreate=Depends(video_create_as_form),
                    image: Optional[UploadFile] = File(None),
                    db: Session = Depends(get_database),
@@ -178,27 +165,81 @@ async def generate_video(background_tasks: BackgroundTasks,
         image_data = await image.read()
         image_str= base64.b64encode(image_data).decode('utf-8')
 
+    seconds = parse_seconds(video_in.sec)
+    quota_error = usage.reserve(db, current_user.id, seconds)
+    if quota_error:
+        db.rollback()
+        raise HTTPException(status_code=429, detail=quota_error)
+
+    # The job is only queued here; jobs.runner submits it as soon as a deployment can
+    # take it, so the request never waits on (or blocks a thread for) the upstream.
     db_video = models.VideoGeneration(
         prompt=video_in.prompt,
-        status = "processing",
+        status = "queued",
+        seconds = seconds,
         user_id=current_user.id
     )
     db.add(db_video)
+    db.flush()
+    db.add(models.VideoSubmission(
+        video_id=db_video.id,
+        size_str=video_in.size_str,
+        sec=video_in.sec,
+        image=image_str
+    ))
     db.commit()
     db.refresh(db_video)
-    print(video_in.size_str)
-
-    background_tasks.add_task(
-        run_azure,
-        db_video.id,
-        video_in.prompt,
-        video_in.size_str,
-        video_in.sec,
-        image_str
-    )
+    jobs.runner.wake()
     return db_video
 
 
+CHANGES_PAGE_SIZE = 500
+
+
+@app.get("/videos/changes", response_model=schemas.VideoChanges)
+def get_video_changes(
+    since: int = 0,
+    fast: bool = False,
+    db: Session = Depends(get_database),
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    # read first: every change up to here is committed, so the queries below see it
+    latest = models.current_sequence(db, "video_changes")
+    # one indexed range scan on (user_id, change_seq) replaces a status poll per video
+    columns = (*serializers.VIDEO_COLUMNS, models.VideoGeneration.change_seq) if fast else (models.VideoGeneration,)
+    videos = db.query(*columns).filter(
+        models.VideoGeneration.user_id == current_user.id,
+        models.VideoGeneration.change_seq > since
+    ).order_by(models.VideoGeneration.change_seq).limit(CHANGES_PAGE_SIZE + 1).all()
+    tombstones = db.query(models.VideoTombstone.video_id, models.VideoTombstone.change_seq).filter(
+        models.VideoTombstone.user_id == current_user.id,
+        models.VideoTombstone.change_seq > since
+    ).order_by(models.VideoTombstone.change_seq).limit(CHANGES_PAGE_SIZE + 1).all()
+
+    # one page in change order across both, so the cursor never skips past either
+    merged = sorted([(v.change_seq, False, v) for v in videos] + [(t.change_seq, True, t) for t in tombstones],
+                    key=lambda change: change[0])
+    has_more = len(merged) > CHANGES_PAGE_SIZE
+    merged = merged[:CHANGES_PAGE_SIZE]
+    cursor = merged[-1][0] if merged else since
+    if not has_more:
+        # skip past other users' changes too, so idle cursors don't fall behind the
+        # tombstone pruning watermark
+        cursor = max(cursor, latest)
+    videos = [item for _, is_removed, item in merged if not is_removed]
+    removed = [item.video_id for _, is_removed, item in merged if is_removed]
+    live_ids = None
+    if 0 < since < models.current_sequence(db, models.PRUNED_TOMBSTONES_SEQUENCE):
+        # removals this old were pruned, so send what still exists instead
+        live_ids = [row.id for row in db.query(models.VideoGeneration.id).filter(
+            models.VideoGeneration.user_id == current_user.id)]
+    if fast:
+        content = {"changes": serializers.video_rows(videos, current_user.id), "removed": removed,
+                   "live_ids": live_ids, "cursor": cursor, "has_more": has_more}
+        return Response(serializers.dumps(content), media_type="application/json")
+    return {"changes": videos, "removed": removed, "live_ids": live_ids, "cursor": cursor, "has_more": has_more}
+
+
 @app.get("/videos/{video_id}", response_model=schemas.VideoResponse)
 def get_video_status(
     video_id: int, 
@@ -215,45 +256,147 @@ def get_video_status(
         
     return video
 
-@app.get("/videos/{video_id}/stream")
-async def secure_vidstream(video_id: int, db:Session = Depends(get_database),
-                           current_user: models.User = Depends(auth.get_current_user)
-                           ):
+# how long a worker may serve a stream URL from its memo; bounds how long other workers
+# keep streaming a video after retention removed it
+STREAM_MEMO_SECONDS = int(os.getenv("STREAM_MEMO_SECONDS", "300"))
+
+
+@lru_cache(maxsize=4096)
+def resolve_stream_url(video_id: int, user_id: int, memo_epoch: int) -> str:
+    # memoized per (video, owner, epoch) so repeated range requests skip the database;
+    # raises LookupError for missing or unfinished videos, which lru_cache does not remember
+    db = database.SessionLocal()
+    try:
+        video = db.query(models.VideoGeneration).filter(
+            models.VideoGeneration.id == video_id,
+            models.VideoGeneration.user_id == user_id).first()
+        if not video or not video.video_url:
+            raise LookupError(video_id)
+        deployment = videogen.pool.get(video.deployment)
+        return f"{video.video_url}?api-version=preview&api-key={deployment.key}"
+    finally:
+        db.close()
+
+
+def cancel_videos(db: Session, user_id: int, video_ids: list[int]):
+    videos = db.query(models.VideoGeneration).filter(
+        models.VideoGeneration.id.in_(video_ids),
+        models.VideoGeneration.user_id == user_id
+    ).all()
+
+    cancelled = [v for v in videos if v.status not in models.FINISHED_STATUSES]
+    cancelled_ids = [v.id for v in cancelled]
+    # only submitted jobs need stopping upstream; queued ones are simply never sent
+    upstream_jobs = [(v.job_id, v.deployment) for v in cancelled if v.job_id]
+    for video in cancelled:
+        video.status = "cancelled"
+    if cancelled_ids:
+        db.query(models.VideoSubmission).filter(
+            models.VideoSubmission.video_id.in_(cancelled_ids)
+        ).delete(synchronize_session=False)
+    db.commit()
+
+    # the poller skips cancelled rows, so the job stops being polled right away
+    jobs.runner.cancel(upstream_jobs)
+    return cancelled_ids, [i for i in video_ids if i not in cancelled_ids]
+
+
+@app.delete("/videos/{video_id}", response_model=schemas.VideoResponse)
+def cancel_video(
+    video_id: int,
+    db: Session = Depends(get_database),
+    current_user: models.User = Depends(auth.get_current_user)
+):
     video = db.query(models.VideoGeneration).filter(
-        models.VideoGeneration.id == video_id).first()
-     
-    if not video or not video.video_url:
+        models.VideoGeneration.id == video_id,
+        models.VideoGeneration.user_id == current_user.id
+    ).first()
+
+    if not video:
+        raise HTTPException(status_code=404, detail="Video not found")
+    if video.status in models.FINISHED_STATUSES:
+        raise HTTPException(status_code=409, detail=f"Video is already {video.status.lower()}")
+
+    cancel_videos(db, current_user.id, [video_id])
+    db.refresh(video)
+    return video
+
+
+@app.post("/videos/cancel", response_model=schemas.VideoCancelResult)
+def cancel_video_batch(
+    cancel_in: schemas.VideoCancelRequest,
+    db: Session = Depends(get_database),
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    cancelled, not_cancelled = cancel_videos(db, current_user.id, cancel_in.ids)
+    return {"cancelled": cancelled, "not_cancelled": not_cancelled}
+
+
+@app.get("/videos/{video_id}/stream")
+def secure_vidstream(video_id: int, token: str, request: Request):
+    # authorized by the signed token from VideoResponse.stream_url instead of a bearer JWT
+    user_id = signing.verify_stream_token(token, video_id)
+    if user_id is None:
+        raise HTTPException(status_code=401, detail="Invalid or expired stream link")
+
+    try:
+        secure_url = resolve_stream_url(video_id, user_id, int(time.time() // STREAM_MEMO_SECONDS))
+    except LookupError:
         raise HTTPException(status_code=404, detail="Video not found or not ready")
-    print(f"DEBUG: Found video! URL is {video.video_url}")
-    
-    secure_url = f"{video.video_url}?api-version=preview&api-key={videogen.SORA_KEY}"
+
+    # forward the browser's Range header so seeking fetches only the requested bytes
+    upstream_headers = {}
+    if request.headers.get("range"):
+        upstream_headers["Range"] = request.headers["range"]
+    r = requests.get(secure_url, headers=upstream_headers, stream=True, timeout=videogen.REQUEST_TIMEOUT)
+    if r.status_code >= 400:
+        r.close()
+        raise HTTPException(status_code=502, detail="Video could not be fetched")
 
     def generate_stream():
-        with requests.get(secure_url, stream=True) as r:
-            r.raise_for_status()
+        try:
             for chunk in r.iter_content(chunk_size=8192):
                 if chunk:
                     yield chunk
+        finally:
+            r.close()
 
     # FIX: Added proper HTTP headers for video streaming
     # "Accept-Ranges: bytes" allows browser to seek/scrub through video
     # "Content-Disposition: inline" tells browser to play video instead of downloading
+    # The URL itself is the credential, so a proxy may cache it until the token expires
+
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f"inline; filename=video_{video_id}.mp4",
+        "Cache-Control": f"public, max-age={signing.STREAM_URL_TTL_SECONDS}",
+    }
+    for name in ("Content-Range", "Content-Length"):
+        if name in r.headers:
+            headers[name] = r.headers[name]
 
     return StreamingResponse(
         generate_stream(), 
+        status_code=r.status_code,
         media_type="video/mp4",
-        headers={
-            "Accept-Ranges": "bytes",
-            "Content-Disposition": f"inline; filename=video_{video_id}.mp4"
-        }
+        headers=headers
     )
 
 
 @app.get("/videos", response_model=list[schemas.VideoResponse])
 def get_user_videos(
+    fast: bool = False,
     db: Session = Depends(get_database),
     current_user: models.User = Depends(auth.get_current_user)
 ):
+    if fast:
+        # same JSON as below, without building an ORM object and a Pydantic model per row
+        rows = db.query(*serializers.VIDEO_COLUMNS).filter(
+            models.VideoGeneration.user_id == current_user.id
+        ).order_by(models.VideoGeneration.created_at.desc()).all()
+        return Response(serializers.dumps(serializers.video_rows(rows, current_user.id)),
+                        media_type="application/json")
+
     # Fetch all videos for the user, newest first
     videos = db.query(models.VideoGeneration).filter(
         models.VideoGeneration.user_id == current_user.id
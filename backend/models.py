@@ -1,9 +1,13 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, Text, Boolean, ForeignKey, DateTime, Date, Index, event, inspect, text
 from .database import Base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, Session, column_property
 import datetime
 
 
+# statuses after which a job can no longer change or be cancelled
+FINISHED_STATUSES = {"Completed", "Failed", "failed", "cancelled"}
+
+
 
 class User(Base):
     __tablename__= "users"
@@ -22,7 +26,169 @@ class VideoGeneration(Base):
     id = Column(Integer,primary_key= True)
     prompt = Column(String)
     video_url = Column(String)
-    status = Column(String)
-    created_at = Column(DateTime, default=datetime.datetime.now(datetime.timezone.utc))
+    # active_history so flush hooks always see the previous status, even on an expired row
+    status = column_property(Column(String), active_history=True)
+    # name of the Sora deployment that owns the upstream job (see videogen.pool)
+    deployment = Column(String, nullable=True)
+    # a callable, so each row gets its own insert time rather than the process start time
+    created_at = Column(DateTime, default=lambda: datetime.datetime.now(datetime.timezone.utc))
     user_id = Column(Integer, ForeignKey('users.id'))
     owner = relationship("User", back_populates="videos")
+    # upstream job id once submitted; jobs.py polls rows that have one
+    job_id = Column(String, nullable=True)
+    # when the poller may look at this job next; moved forward to claim a poll
+    next_poll_at = Column(DateTime, nullable=True)
+    poll_errors = Column(Integer, default=0)
+    # requested clip length, counted into usage once the video completes
+    seconds = Column(Integer, default=0)
+    # when the upstream accepted the job; its run time is measured from here, not from
+    # created_at, which includes time spent in the queue
+    submitted_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    # bumped from the global change sequence whenever a client-visible field changes,
+    # so GET /videos/changes can return just the rows newer than a client's cursor
+    change_seq = Column(Integer, default=0, nullable=False)
+
+    __table_args__ = (
+        Index("ix_video_generations_user_change_seq", "user_id", "change_seq"),
+        Index("ix_video_generations_created_at", "created_at"),
+        Index("ix_video_generations_status_next_poll_at", "status", "next_poll_at"),
+        # never hand out the id of an archived row again: stream tokens and caches key on it
+        {"sqlite_autoincrement": True},
+    )
+
+
+class VideoSubmission(Base):
+    # the arguments of a job that is waiting to be submitted upstream; the job dispatcher
+    # deletes the row once the job is accepted or has definitely failed
+    __tablename__ = "video_submissions"
+
+    video_id = Column(Integer, ForeignKey('video_generations.id'), primary_key=True)
+    size_str = Column(String)
+    sec = Column(String)
+    image = Column(Text, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, default=lambda: datetime.datetime.now(datetime.timezone.utc), index=True)
+
+
+class VideoGenerationHistory(Base):
+    # compact archive of old finished generations written by retention.py: no prompt and
+    # no (long expired) upstream URL, just what usage and reporting still need
+    __tablename__ = "video_generation_history"
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    id = Column(Integer, primary_key=True)
+    video_id = Column(Integer, index=True)
+    user_id = Column(Integer, index=True)
+    status = Column(String)
+    seconds = Column(Integer, default=0)
+    deployment = Column(String, nullable=True)
+    created_at = Column(DateTime)
+    finished_at = Column(DateTime, nullable=True)
+    archived_at = Column(DateTime)
+
+
+class VideoTombstone(Base):
+    # left behind when retention.py removes a generation, so /videos/changes can tell
+    # delta-sync clients to drop it; pruned after RETENTION_DAYS
+    __tablename__ = "video_tombstones"
+    __table_args__ = (
+        Index("ix_video_tombstones_user_change_seq", "user_id", "change_seq"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    video_id = Column(Integer)
+    user_id = Column(Integer)
+    change_seq = Column(Integer, nullable=False)
+    removed_at = Column(DateTime, index=True)
+
+
+class UserUsage(Base):
+    # running totals per user, maintained incrementally by usage.py
+    __tablename__ = "user_usage"
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    in_flight = Column(Integer, nullable=False, default=0)
+    # seconds requested by in-flight generations, held against the daily seconds quota
+    reserved_seconds = Column(Integer, nullable=False, default=0)
+    total_generations = Column(Integer, nullable=False, default=0)
+    total_seconds = Column(Integer, nullable=False, default=0)
+
+
+class UserDailyUsage(Base):
+    __tablename__ = "user_daily_usage"
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    day = Column(Date, primary_key=True)
+    generations = Column(Integer, nullable=False, default=0)
+    seconds = Column(Integer, nullable=False, default=0)
+
+
+class SequenceCounter(Base):
+    __tablename__ = "sequence_counters"
+
+    name = Column(String, primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+
+
+class ScheduledTask(Base):
+    # last run and lock of periodic maintenance shared by every worker process
+    __tablename__ = "scheduled_tasks"
+
+    name = Column(String, primary_key=True)
+    last_run_at = Column(DateTime, nullable=True)
+    locked_until = Column(DateTime, nullable=True)
+    locked_by = Column(String, nullable=True)
+
+
+# highest change_seq of a pruned tombstone: cursors below it may have missed a removal
+PRUNED_TOMBSTONES_SEQUENCE = "video_tombstones_pruned"
+
+# fields whose change must reach delta-sync clients
+VIDEO_SYNC_FIELDS = ("status", "video_url")
+
+
+def next_sequence(session: Session, name: str, count: int = 1) -> int:
+    """Take the next `count` values of sequence `name` and return the last one."""
+    # the UPDATE takes SQLite's write lock, so the value read back is unique and increasing
+    params = {"name": name, "count": count}
+    result = session.execute(
+        text("UPDATE sequence_counters SET value = value + :count WHERE name = :name"), params)
+    if result.rowcount == 0:
+        session.execute(
+            text("INSERT INTO sequence_counters (name, value) VALUES (:name, :count)"), params)
+    return current_sequence(session, name)
+
+
+def current_sequence(session: Session, name: str) -> int:
+    return session.execute(
+        text("SELECT COALESCE(MAX(value), 0) FROM sequence_counters WHERE name = :name"),
+        {"name": name}).scalar_one()
+
+
+def backfill_change_seq(session: Session) -> int:
+    """Give rows that predate change_seq a place in the sequence, so since=0 returns them."""
+    base = session.execute(
+        text("SELECT COALESCE(MAX(value), 0) FROM sequence_counters WHERE name = 'video_changes'")).scalar()
+    # ids are unique, so base + id is a unique, increasing value above every existing one
+    result = session.execute(text(
+        "UPDATE video_generations SET change_seq = :base + id "
+        "WHERE change_seq IS NULL OR change_seq = 0"), {"base": base})
+    if result.rowcount:
+        top = session.execute(text("SELECT MAX(change_seq) FROM video_generations")).scalar()
+        session.execute(text(
+            "INSERT OR IGNORE INTO sequence_counters (name, value) VALUES ('video_changes', 0)"))
+        session.execute(text(
+            "UPDATE sequence_counters SET value = MAX(value, :top) WHERE name = 'video_changes'"), {"top": top})
+    session.commit()
+    return result.rowcount
+
+
+@event.listens_for(Session, "before_flush")
+def _bump_video_change_seq(session, flush_context, instances):
+    for obj in list(session.new) + list(session.dirty):
+        if not isinstance(obj, VideoGeneration):
+            continue
+        state = inspect(obj)
+        if obj in session.new or any(state.attrs[f].history.has_changes() for f in VIDEO_SYNC_FIELDS):
+            obj.change_seq = next_sequence(session, "video_changes")
@@ -0,0 +1,301 @@
+# scheduled compaction: archives old finished generations into video_generation_history
+# (leaving tombstones for delta-sync clients), removes orphans, prunes cached media and
+# returns free pages to the filesystem, all in small batches so live requests only ever
+# wait for one short write transaction
+#
+# run once by hand: python -m backend.retention [--full-vacuum]
+
+import os
+import sys
+import time
+import threading
+import datetime
+import uuid
+from typing import Optional
+
+from sqlalchemy import text
+
+from . import models, database
+
+
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "30"))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "500"))
+# pause between batches so queued writers get the SQLite lock
+RETENTION_BATCH_PAUSE_SECONDS = float(os.getenv("RETENTION_BATCH_PAUSE_SECONDS", "0.05"))
+RETENTION_INTERVAL_HOURS = float(os.getenv("RETENTION_INTERVAL_HOURS", "24"))
+# how often each process checks whether a pass is due
+RETENTION_CHECK_SECONDS = float(os.getenv("RETENTION_CHECK_SECONDS", "600"))
+# a pass holding the lock longer than this is presumed dead and may be taken over
+RETENTION_LOCK_SECONDS = float(os.getenv("RETENTION_LOCK_SECONDS", "7200"))
+TASK_NAME = "retention"
+# pages freed per incremental vacuum batch
+RETENTION_VACUUM_PAGES = int(os.getenv("RETENTION_VACUUM_PAGES", "1000"))
+# optional local media cache; files older than RETENTION_DAYS are removed
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR")
+
+
+def _finished_params() -> dict:
+    return {f"s{i}": s for i, s in enumerate(sorted(models.FINISHED_STATUSES))}
+
+
+def _in_clause(params: dict) -> str:
+    return ", ".join(f":{name}" for name in params)
+
+
+def _now() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+def _db_bytes(db) -> int:
+    page_size = db.execute(text("PRAGMA page_size")).scalar()
+    page_count = db.execute(text("PRAGMA page_count")).scalar()
+    return page_size * page_count
+
+
+def _batched(db, select_ids: str, params: dict, apply) -> int:
+    total = 0
+    while True:
+        ids = [row[0] for row in db.execute(text(select_ids), {**params, "limit": RETENTION_BATCH_SIZE})]
+        if not ids:
+            return total
+        apply(ids)
+        db.commit()
+        total += len(ids)
+        if len(ids) < RETENTION_BATCH_SIZE:
+            return total
+        time.sleep(RETENTION_BATCH_PAUSE_SECONDS)
+
+
+# without AUTOINCREMENT (databases created before it was set) SQLite gives a new row the
+# highest id + 1, so removing the highest row would hand its id out again; it stays
+_KEEP_TOP_ID = "SELECT MAX(id) FROM video_generations"
+
+
+def archive_old_generations(db, cutoff: datetime.datetime) -> int:
+    finished = _finished_params()
+    params = {**finished, "cutoff": cutoff.strftime("%Y-%m-%d %H:%M:%S.%f")}
+    select_ids = (
+        "SELECT id FROM video_generations "
+        f"WHERE created_at < :cutoff AND status IN ({_in_clause(finished)}) AND id < ({_KEEP_TOP_ID}) "
+        "ORDER BY created_at LIMIT :limit")
+
+    def apply(ids):
+        id_params = {f"id{i}": video_id for i, video_id in enumerate(ids)}
+        ids_sql = _in_clause(id_params)
+        db.execute(text(
+            "INSERT INTO video_generation_history "
+            "(video_id, user_id, status, seconds, deployment, created_at, finished_at, archived_at) "
+            "SELECT id, user_id, status, seconds, deployment, created_at, finished_at, :now "
+            f"FROM video_generations WHERE id IN ({ids_sql})"),
+            {**id_params, "now": _now()})
+        # each removal takes its own place in the change sequence for /videos/changes
+        last = models.next_sequence(db, "video_changes", len(ids))
+        db.execute(text(
+            "INSERT INTO video_tombstones (video_id, user_id, change_seq, removed_at) "
+            "SELECT id, user_id, :first + ROW_NUMBER() OVER (ORDER BY id) - 1, :now "
+            f"FROM video_generations WHERE id IN ({ids_sql})"),
+            {**id_params, "first": last - len(ids) + 1, "now": _now()})
+        db.execute(text(f"DELETE FROM video_generations WHERE id IN ({ids_sql})"), id_params)
+
+    return _batched(db, select_ids, params, apply)
+
+
+def prune_tombstones(db, cutoff: datetime.datetime) -> int:
+    # clients whose cursor predates a pruned tombstone are told to resync from scratch
+    select_ids = "SELECT id FROM video_tombstones WHERE removed_at < :cutoff ORDER BY id LIMIT :limit"
+
+    def apply(ids):
+        id_params = {f"id{i}": tombstone_id for i, tombstone_id in enumerate(ids)}
+        ids_sql = _in_clause(id_params)
+        db.execute(text(
+            "INSERT OR IGNORE INTO sequence_counters (name, value) VALUES (:name, 0)"),
+            {"name": models.PRUNED_TOMBSTONES_SEQUENCE})
+        db.execute(text(
+            "UPDATE sequence_counters SET value = MAX(value, "
+            f"(SELECT MAX(change_seq) FROM video_tombstones WHERE id IN ({ids_sql}))) WHERE name = :name"),
+            {**id_params, "name": models.PRUNED_TOMBSTONES_SEQUENCE})
+        db.execute(text(f"DELETE FROM video_tombstones WHERE id IN ({ids_sql})"), id_params)
+
+    return _batched(db, select_ids, {"cutoff": cutoff.strftime("%Y-%m-%d %H:%M:%S.%f")}, apply)
+
+
+def remove_orphans(db) -> int:
+    # generations whose owner is gone can never be listed or streamed again, and nobody is
+    # left to sync them, so they leave no tombstones
+    select_ids = (
+        "SELECT v.id FROM video_generations v LEFT JOIN users u ON u.id = v.user_id "
+        f"WHERE u.id IS NULL AND v.id < ({_KEEP_TOP_ID}) LIMIT :limit")
+
+    def apply(ids):
+        id_params = {f"id{i}": video_id for i, video_id in enumerate(ids)}
+        db.execute(text(f"DELETE FROM video_generations WHERE id IN ({_in_clause(id_params)})"), id_params)
+
+    removed = _batched(db, select_ids, {}, apply)
+    for table in ("user_usage", "user_daily_usage", "video_tombstones"):
+        result = db.execute(text(
+            f"DELETE FROM {table} WHERE user_id NOT IN (SELECT id FROM users)"))
+        removed += result.rowcount
+    db.commit()
+    return removed
+
+
+def prune_media(cutoff: datetime.datetime):
+    if not MEDIA_CACHE_DIR or not os.path.isdir(MEDIA_CACHE_DIR):
+        return 0, 0
+    files, reclaimed = 0, 0
+    cutoff_ts = cutoff.timestamp()
+    for entry in os.scandir(MEDIA_CACHE_DIR):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff_ts:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                files += 1
+                reclaimed += size
+        except OSError as e:
+            print(f"Retention: could not remove {entry.path}: {e}")
+    return files, reclaimed
+
+
+def vacuum(db, full: bool = False):
+    if full:
+        # one-off, blocks the database: needed once to switch an old file to incremental mode
+        db.execute(text("PRAGMA auto_vacuum=INCREMENTAL"))
+        db.commit()
+        with database.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text("VACUUM"))
+        return
+    if db.execute(text("PRAGMA auto_vacuum")).scalar() != 2:
+        print("Retention: database is not in incremental vacuum mode, run once with --full-vacuum")
+        return
+    free = db.execute(text("PRAGMA freelist_count")).scalar()
+    while free > 0:
+        _incremental_vacuum(db, min(free, RETENTION_VACUUM_PAGES))
+        db.commit()
+        remaining = db.execute(text("PRAGMA freelist_count")).scalar()
+        if remaining >= free:
+            print(f"Retention: incremental vacuum freed nothing, {remaining} free pages left")
+            return
+        free = remaining
+        time.sleep(RETENTION_BATCH_PAUSE_SECONDS)
+
+
+def _incremental_vacuum(db, pages: int):
+    # the pragma frees one page per step, but sqlite3 takes a single step of a statement
+    # without result columns (fetchall() gets nothing), so each call frees exactly one page
+    cursor = db.connection().connection.cursor()
+    try:
+        for _ in range(pages):
+            cursor.execute("PRAGMA incremental_vacuum(1)")
+    finally:
+        cursor.close()
+
+
+def run_compaction(full_vacuum: bool = False) -> dict:
+    """Run one compaction pass and report what it reclaimed."""
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=RETENTION_DAYS)
+    db = database.SessionLocal()
+    try:
+        size_before = _db_bytes(db)
+        archived = archive_old_generations(db, cutoff)
+        orphans = remove_orphans(db)
+        tombstones = prune_tombstones(db, cutoff)
+        media_files, media_bytes = prune_media(cutoff)
+        vacuum(db, full=full_vacuum)
+        # bounded ANALYZE: only refreshes statistics that the planner flags as stale
+        db.execute(text("PRAGMA analysis_limit=1000"))
+        db.execute(text("PRAGMA optimize"))
+        db.commit()
+        report = {
+            "archived_rows": archived,
+            "orphan_rows": orphans,
+            "tombstones_pruned": tombstones,
+            "media_files": media_files,
+            "media_bytes": media_bytes,
+            "db_bytes_reclaimed": max(0, size_before - _db_bytes(db)),
+        }
+    finally:
+        db.close()
+    print(f"Retention: {report}")
+    return report
+
+
+def claim_run(db, name: str, interval: float, lease: float) -> Optional[str]:
+    """Take the lock of task `name` if a run is due. Returns the lock token, or None
+    when the task ran recently or another process holds the lock."""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    db.execute(text("INSERT OR IGNORE INTO scheduled_tasks (name) VALUES (:name)"), {"name": name})
+    token = uuid.uuid4().hex
+    task = models.ScheduledTask
+    claimed = db.query(task).filter(
+        task.name == name,
+        (task.last_run_at.is_(None)) | (task.last_run_at <= now - datetime.timedelta(seconds=interval)),
+        (task.locked_until.is_(None)) | (task.locked_until < now)
+    ).update({"locked_until": now + datetime.timedelta(seconds=lease), "locked_by": token},
+             synchronize_session=False)
+    db.commit()
+    return token if claimed == 1 else None
+
+
+def release_run(db, name: str, token: str, finished: bool):
+    values = {"locked_until": None, "locked_by": None}
+    if finished:
+        values["last_run_at"] = datetime.datetime.now(datetime.timezone.utc)
+    db.query(models.ScheduledTask).filter(
+        models.ScheduledTask.name == name,
+        models.ScheduledTask.locked_by == token
+    ).update(values, synchronize_session=False)
+    db.commit()
+
+
+class CompactionScheduler:
+    """Runs a compaction pass whenever the last one, in any process, is older than the
+    interval. The last run and a lock row live in scheduled_tasks, so an overdue pass runs
+    right after startup and only one worker process runs it."""
+
+    def __init__(self, interval_hours: float = RETENTION_INTERVAL_HOURS, on_done=None):
+        self.interval = interval_hours * 3600
+        self.on_done = on_done
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.interval <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def run_if_due(self) -> Optional[dict]:
+        db = database.SessionLocal()
+        try:
+            token = claim_run(db, TASK_NAME, self.interval, RETENTION_LOCK_SECONDS)
+            if token is None:
+                return None
+            finished = False
+            try:
+                report = run_compaction()
+                finished = True
+            finally:
+                release_run(db, TASK_NAME, token, finished)
+        finally:
+            db.close()
+        if self.on_done:
+            self.on_done(report)
+        return report
+
+    def _run(self):
+        # check straight away, so a pass that came due while no process was up runs now
+        while not self._stop.is_set():
+            try:
+                self.run_if_due()
+            except Exception as e:
+                print(f"Retention: compaction failed: {e}")
+            self._stop.wait(min(self.interval, RETENTION_CHECK_SECONDS))
+
+
+if __name__ == "__main__":
+    models.Base.metadata.create_all(bind=database.engine)
+    run_compaction(full_vacuum="--full-vacuum" in sys.argv[1:])
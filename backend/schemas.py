@@ -3,6 +3,8 @@ from pydantic import BaseModel, EmailStr, Field, computed_field
 from typing import Optional
 import datetime
 
+from . import signing
+
 
 class UserBase(BaseModel):
     email: EmailStr
@@ -40,10 +42,58 @@ class VideoResponse(BaseModel):
     prompt: str
     status: str
     created_at: datetime.datetime
+    user_id: int = Field(exclude=True)
     @computed_field
     @property
     def stream_url(self)-> str:
-        return f"/videos/{self.id}/stream"
+        return f"/videos/{self.id}/stream?token={signing.create_stream_token(self.id, self.user_id)}"
+
+    class Config:
+        from_attributes = True
+
+
+class VideoChanges(BaseModel):
+    changes: list[VideoResponse]
+    # ids of videos that were archived and must be dropped
+    removed: list[int]
+    # only when the cursor predates pruned tombstones: every id the user still has, so
+    # the client can drop the ones missing from it
+    live_ids: Optional[list[int]] = None
+    # pass back as ?since= on the next call
+    cursor: int
+    has_more: bool
+
+
+class VideoCancelRequest(BaseModel):
+    ids: list[int] = Field(min_length=1, max_length=500)
+
+
+class VideoCancelResult(BaseModel):
+    cancelled: list[int]
+    # unknown, not owned by the caller, or already finished
+    not_cancelled: list[int]
+
+
+class DailyUsage(BaseModel):
+    day: datetime.date
+    generations: int
+    seconds: int
 
     class Config:
         from_attributes = True
+
+
+class UsageLimits(BaseModel):
+    daily_generations: int
+    daily_seconds: int
+    in_flight: int
+
+
+class Usage(BaseModel):
+    in_flight: int
+    reserved_seconds: int
+    total_generations: int
+    total_seconds: int
+    today: DailyUsage
+    daily: list[DailyUsage]
+    limits: UsageLimits
@@ -0,0 +1,50 @@
+# opt-in fast path for large video listings: plain column tuples straight from the query,
+# stream URLs signed in bulk and one encoder call, instead of a Pydantic model per row
+
+import json
+import datetime
+
+from . import models, signing
+
+try:
+    import orjson
+except ImportError:  # optional, the stdlib encoder is used without it
+    orjson = None
+
+
+# same fields, same order as schemas.VideoResponse
+VIDEO_COLUMNS = (
+    models.VideoGeneration.id,
+    models.VideoGeneration.prompt,
+    models.VideoGeneration.status,
+    models.VideoGeneration.created_at,
+)
+
+
+def _default(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    # matches fastapi.responses.JSONResponse output
+    return json.dumps(content, default=_default, ensure_ascii=False, allow_nan=False,
+                      separators=(",", ":")).encode("utf-8")
+
+
+def video_rows(rows, user_id: int) -> list:
+    """Build VideoResponse-shaped dicts from rows starting with the VIDEO_COLUMNS."""
+    tokens = signing.create_stream_tokens([row[0] for row in rows], user_id)
+    return [
+        {
+            "id": row[0],
+            "prompt": row[1],
+            "status": row[2],
+            "created_at": row[3],
+            "stream_url": f"/videos/{row[0]}/stream?token={token}",
+        }
+        for row, token in zip(rows, tokens)
+    ]
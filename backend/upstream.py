@@ -0,0 +1,279 @@
+# resilience primitives shared by every call to the Sora upstream:
+# a circuit breaker, a global retry budget and Retry-After aware backoff
+
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", "30"))
+
+# retries may add at most RETRY_BUDGET_RATIO extra load on top of first attempts,
+# plus a small floor so a quiet system can still retry
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.2"))
+RETRY_BUDGET_MIN_PER_SEC = float(os.getenv("RETRY_BUDGET_MIN_PER_SEC", "0.2"))
+RETRY_BUDGET_MAX = float(os.getenv("RETRY_BUDGET_MAX", "20"))
+
+BACKOFF_BASE_SECONDS = float(os.getenv("BACKOFF_BASE_SECONDS", "2"))
+BACKOFF_MAX_SECONDS = float(os.getenv("BACKOFF_MAX_SECONDS", "120"))
+
+HEALTH_CACHE_SECONDS = float(os.getenv("HEALTH_CACHE_SECONDS", "30"))
+
+
+class UpstreamError(Exception):
+    def __init__(self, message: str, status_code: Optional[int] = None,
+                 retry_after: Optional[float] = None, retryable: bool = True):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.retryable = retryable
+
+
+class CircuitOpenError(UpstreamError):
+    def __init__(self, retry_after: float, message: str = "Sora upstream circuit is open"):
+        super().__init__(message, retry_after=retry_after)
+
+
+class NoDeploymentAvailable(CircuitOpenError):
+    # every deployment is either tripped or at capacity; callers queue exactly as for an open circuit
+    def __init__(self, retry_after: float):
+        super().__init__(retry_after, "No Sora deployment has capacity")
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    # the server's Retry-After wins; otherwise exponential backoff with jitter
+    if retry_after is not None:
+        return min(retry_after, BACKOFF_MAX_SECONDS)
+    delay = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** max(0, attempt - 1)))
+    return random.uniform(delay / 2, delay)
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_seconds: float = BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._open_for = reset_seconds
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self._open_for:
+            self._state = self.HALF_OPEN
+            self._probe_in_flight = False
+        return self._state
+
+    def retry_in(self) -> float:
+        with self._lock:
+            if self._current_state() != self.OPEN:
+                return 0.0
+            return max(0.0, self._open_for - (time.monotonic() - self._opened_at))
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go through right now.
+        In half-open state exactly one probe call is let through."""
+        with self._lock:
+            state = self._current_state()
+            if state == self.CLOSED:
+                return
+            if state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return
+            wait = self._open_for - (time.monotonic() - self._opened_at) if state == self.OPEN else 1.0
+            raise CircuitOpenError(retry_after=max(wait, 1.0))
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self, retry_after: Optional[float] = None):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._open_for = max(self.reset_seconds, retry_after or 0.0)
+                self._probe_in_flight = False
+                print(f"Circuit opened for {self._open_for:.0f}s after {self._failures} failures")
+
+
+class RetryBudget:
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO,
+                 min_per_sec: float = RETRY_BUDGET_MIN_PER_SEC,
+                 max_tokens: float = RETRY_BUDGET_MAX):
+        self.ratio = ratio
+        self.min_per_sec = min_per_sec
+        self.max_tokens = max_tokens
+        self._lock = threading.Lock()
+        self._tokens = max_tokens
+        self._last = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.max_tokens, self._tokens + (now - self._last) * self.min_per_sec)
+        self._last = now
+
+    def record_request(self):
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+
+class Deployment:
+    """One upstream Sora deployment with its own key, quota and breaker."""
+
+    # weight of the newest sample in the latency moving average
+    LATENCY_ALPHA = 0.2
+
+    def __init__(self, name: str, endpoint: str, key: str, capacity: Optional[int] = None, weight: float = 1.0):
+        self.name = name
+        self.endpoint = endpoint
+        self.key = key
+        # max concurrent jobs; None means no local limit, only the upstream's own throttling
+        self.capacity = capacity
+        self.weight = weight
+        self.breaker = CircuitBreaker()
+        self.in_flight = 0
+        self.latency = None
+
+    @property
+    def raw_endpoint(self) -> str:
+        return self.endpoint.split('?')[0]
+
+    @property
+    def base_url(self) -> str:
+        return self.endpoint.split('/jobs')[0]
+
+    def observe_latency(self, seconds: float):
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += self.LATENCY_ALPHA * (seconds - self.latency)
+
+    def snapshot(self) -> dict:
+        return {
+            "name": self.name,
+            "circuit": self.breaker.state,
+            "in_flight": self.in_flight,
+            "capacity": self.capacity,
+            "weight": self.weight,
+            "latency_ms": None if self.latency is None else round(self.latency * 1000),
+        }
+
+
+class DeploymentPool:
+    """Routes new jobs to the deployment with the lowest weighted load.
+
+    A deployment's score is (in_flight + 1) * observed latency / weight, so a faster or
+    heavier-weighted deployment takes proportionally more work. In-flight counts come from
+    the database (see jobs.py) via set_in_flight(), so they hold across processes and
+    restarts; acquire() only counts the slot it hands out until the next refresh."""
+
+    # latency assumed for a deployment before it has served any request
+    DEFAULT_LATENCY = 1.0
+
+    def __init__(self, deployments):
+        if not deployments:
+            raise RuntimeError("At least one Sora deployment must be configured")
+        self.deployments = {d.name: d for d in deployments}
+        self._lock = threading.Lock()
+
+    def get(self, name: Optional[str]) -> Deployment:
+        # rows created before deployments were tracked belong to the first one
+        if name and name in self.deployments:
+            return self.deployments[name]
+        return next(iter(self.deployments.values()))
+
+    def acquire(self) -> Deployment:
+        with self._lock:
+            best, best_score = None, None
+            for d in self.deployments.values():
+                if (d.capacity is not None and d.in_flight >= d.capacity) or d.breaker.state == CircuitBreaker.OPEN:
+                    continue
+                score = (d.in_flight + 1) * (d.latency or self.DEFAULT_LATENCY) / max(d.weight, 1e-6)
+                if best_score is None or score < best_score:
+                    best, best_score = d, score
+            if best is None:
+                # wake up when the first tripped breaker reopens, or re-check shortly for freed slots
+                waits = [w for w in (d.breaker.retry_in() for d in self.deployments.values()) if w > 0]
+                raise NoDeploymentAvailable(retry_after=max(1.0, min(waits) if waits else 5.0))
+            best.in_flight += 1
+            return best
+
+    def set_in_flight(self, counts: dict):
+        with self._lock:
+            for d in self.deployments.values():
+                d.in_flight = counts.get(d.name, 0)
+
+    def snapshot(self) -> list:
+        with self._lock:
+            return [d.snapshot() for d in self.deployments.values()]
+
+
+class HealthCache:
+    """Memoizes the result of a health probe so readiness checks never fan out to the upstream."""
+
+    def __init__(self, probe, ttl: float = HEALTH_CACHE_SECONDS):
+        self.probe = probe
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._result = None
+        self._checked_at = 0.0
+
+    def get(self) -> dict:
+        with self._lock:
+            if self._result is None or time.monotonic() - self._checked_at >= self.ttl:
+                try:
+                    self._result = self.probe()
+                except Exception as e:
+                    self._result = {"healthy": False, "detail": str(e)}
+                self._checked_at = time.monotonic()
+            result = dict(self._result)
+        result["checked_seconds_ago"] = round(time.monotonic() - self._checked_at, 1)
+        return result
+
+
+retry_budget = RetryBudget()
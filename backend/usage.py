@@ -0,0 +1,185 @@
+# materialized per-user usage: running totals and daily rollups. reserve() counts a new
+# generation and checks the quota in one statement; a flush hook on VideoGeneration keeps
+# the counters up to date as jobs finish, so /users/me/usage is a primary-key read
+#
+# rebuild from history: python -m backend.usage rebuild
+
+import os
+import sys
+import datetime
+from typing import Optional
+
+from sqlalchemy import event, inspect, text
+from sqlalchemy.orm import Session
+
+from . import models, database
+
+
+QUOTA_DAILY_GENERATIONS = int(os.getenv("QUOTA_DAILY_GENERATIONS", "50"))
+QUOTA_DAILY_SECONDS = int(os.getenv("QUOTA_DAILY_SECONDS", "600"))
+QUOTA_MAX_IN_FLIGHT = int(os.getenv("QUOTA_MAX_IN_FLIGHT", "3"))
+
+
+def _today() -> datetime.date:
+    return datetime.datetime.now(datetime.timezone.utc).date()
+
+
+def _bump(session: Session, user_id: int, day: datetime.date,
+          in_flight: int = 0, generations: int = 0, seconds: int = 0, reserved: int = 0):
+    params = {"user_id": user_id, "day": day.isoformat(), "in_flight": in_flight,
+              "generations": generations, "seconds": seconds, "reserved": reserved}
+    session.execute(text(
+        "INSERT INTO user_usage (user_id, in_flight, reserved_seconds, total_generations, total_seconds) "
+        "VALUES (:user_id, MAX(0, :in_flight), MAX(0, :reserved), :generations, :seconds) "
+        "ON CONFLICT(user_id) DO UPDATE SET "
+        "in_flight = MAX(0, in_flight + :in_flight), "
+        "reserved_seconds = MAX(0, reserved_seconds + :reserved), "
+        "total_generations = total_generations + :generations, "
+        "total_seconds = total_seconds + :seconds"), params)
+    if generations or seconds:
+        session.execute(text(
+            "INSERT INTO user_daily_usage (user_id, day, generations, seconds) "
+            "VALUES (:user_id, :day, :generations, :seconds) "
+            "ON CONFLICT(user_id, day) DO UPDATE SET "
+            "generations = generations + :generations, seconds = seconds + :seconds"), params)
+
+
+def _finish(session: Session, video: models.VideoGeneration, was_in_flight: bool):
+    video.finished_at = datetime.datetime.now(datetime.timezone.utc)
+    seconds = (video.seconds or 0) if video.status == "Completed" else 0
+    _bump(session, video.user_id, _today(), in_flight=-1 if was_in_flight else 0, seconds=seconds,
+          reserved=-(video.seconds or 0) if was_in_flight else 0)
+
+
+@event.listens_for(Session, "before_flush")
+def _track_usage(session, flush_context, instances):
+    # runs inside the same transaction as the status change, so the counters can't drift
+    for obj in list(session.new):
+        if not isinstance(obj, models.VideoGeneration) or obj.user_id is None:
+            continue
+        # new in-flight generations were already counted by reserve(), together with the
+        # quota check; only rows that arrive finished (imports, fixtures) are counted here
+        if obj.status in models.FINISHED_STATUSES:
+            _bump(session, obj.user_id, _today(), generations=1)
+            _finish(session, obj, was_in_flight=False)
+
+    for obj in list(session.dirty):
+        if not isinstance(obj, models.VideoGeneration) or obj.user_id is None:
+            continue
+        history = inspect(obj).attrs.status.history
+        if not history.has_changes():
+            continue
+        previous = history.deleted[0] if history.deleted else None
+        if previous not in models.FINISHED_STATUSES and obj.status in models.FINISHED_STATUSES:
+            _finish(session, obj, was_in_flight=True)
+
+    for obj in list(session.deleted):
+        if isinstance(obj, models.VideoGeneration) and obj.user_id is not None \
+                and obj.status not in models.FINISHED_STATUSES:
+            _bump(session, obj.user_id, _today(), in_flight=-1, reserved=-(obj.seconds or 0))
+
+
+def get_usage(db: Session, user_id: int, days: int = 1) -> dict:
+    totals = db.get(models.UserUsage, user_id)
+    since = _today() - datetime.timedelta(days=days - 1)
+    daily = db.query(models.UserDailyUsage).filter(
+        models.UserDailyUsage.user_id == user_id,
+        models.UserDailyUsage.day >= since
+    ).order_by(models.UserDailyUsage.day.desc()).all()
+    today = daily[0] if daily and daily[0].day == _today() else None
+    return {
+        "in_flight": totals.in_flight if totals else 0,
+        "reserved_seconds": totals.reserved_seconds if totals else 0,
+        "total_generations": totals.total_generations if totals else 0,
+        "total_seconds": totals.total_seconds if totals else 0,
+        "today": {
+            "day": _today(),
+            "generations": today.generations if today else 0,
+            "seconds": today.seconds if today else 0,
+        },
+        "daily": daily,
+        "limits": {
+            "daily_generations": QUOTA_DAILY_GENERATIONS,
+            "daily_seconds": QUOTA_DAILY_SECONDS,
+            "in_flight": QUOTA_MAX_IN_FLIGHT,
+        },
+    }
+
+
+def reserve(db: Session, user_id: int, seconds: int) -> Optional[str]:
+    """Count a new generation of `seconds` against the user's quota, or return why it
+    would exceed it. Must run in the transaction that inserts the generation: the check
+    and the increment are one conditional UPDATE, which also holds SQLite's write lock
+    until that insert commits, so concurrent requests can't all slip under the limit."""
+    params = {"user_id": user_id, "day": _today().isoformat(), "seconds": seconds,
+              "max_in_flight": QUOTA_MAX_IN_FLIGHT, "max_generations": QUOTA_DAILY_GENERATIONS,
+              "max_seconds": QUOTA_DAILY_SECONDS}
+    db.execute(text(
+        "INSERT OR IGNORE INTO user_usage (user_id, in_flight, reserved_seconds, total_generations, total_seconds) "
+        "VALUES (:user_id, 0, 0, 0, 0)"), params)
+    db.execute(text(
+        "INSERT OR IGNORE INTO user_daily_usage (user_id, day, generations, seconds) "
+        "VALUES (:user_id, :day, 0, 0)"), params)
+    # seconds of in-flight jobs are reserved up front, so they can't each spend the
+    # whole remaining daily budget
+    reserved = db.execute(text(
+        "UPDATE user_usage SET in_flight = in_flight + 1, reserved_seconds = reserved_seconds + :seconds "
+        "WHERE user_id = :user_id AND in_flight < :max_in_flight "
+        "AND (SELECT generations FROM user_daily_usage WHERE user_id = :user_id AND day = :day) < :max_generations "
+        "AND (SELECT seconds FROM user_daily_usage WHERE user_id = :user_id AND day = :day) "
+        "    + reserved_seconds + :seconds <= :max_seconds"), params)
+    if reserved.rowcount == 1:
+        _bump(db, user_id, _today(), generations=1)
+        return None
+
+    totals = db.get(models.UserUsage, user_id)
+    today = db.get(models.UserDailyUsage, (user_id, _today()))
+    if totals.in_flight >= QUOTA_MAX_IN_FLIGHT:
+        return f"At most {QUOTA_MAX_IN_FLIGHT} generations can run at once"
+    if today.generations >= QUOTA_DAILY_GENERATIONS:
+        return f"Daily limit of {QUOTA_DAILY_GENERATIONS} generations reached"
+    return f"Daily limit of {QUOTA_DAILY_SECONDS} seconds of video reached"
+
+
+def rebuild(db: Session):
+    """Recompute every counter from video_generations and the archived history,
+    e.g. after a deploy or manual edits."""
+    finished = ", ".join(f"'{s}'" for s in sorted(models.FINISHED_STATUSES))
+    # archived rows are finished, so they only ever add to the totals
+    db.execute(text(
+        "CREATE TEMP VIEW IF NOT EXISTS all_generations AS "
+        "SELECT user_id, status, seconds, created_at, finished_at FROM video_generations "
+        "UNION ALL "
+        "SELECT user_id, status, seconds, created_at, finished_at FROM video_generation_history"))
+    db.execute(text("DELETE FROM user_daily_usage"))
+    db.execute(text("DELETE FROM user_usage"))
+    db.execute(text(
+        "INSERT INTO user_daily_usage (user_id, day, generations, seconds) "
+        "SELECT user_id, day, SUM(generations), SUM(seconds) FROM ("
+        "  SELECT user_id, date(created_at) AS day, 1 AS generations, 0 AS seconds "
+        "  FROM all_generations WHERE user_id IS NOT NULL "
+        "  UNION ALL "
+        "  SELECT user_id, date(COALESCE(finished_at, created_at)), 0, COALESCE(seconds, 0) "
+        "  FROM all_generations WHERE user_id IS NOT NULL AND status = 'Completed'"
+        ") GROUP BY user_id, day"))
+    db.execute(text(
+        "INSERT INTO user_usage (user_id, in_flight, reserved_seconds, total_generations, total_seconds) "
+        "SELECT user_id, "
+        f"  SUM(CASE WHEN status IN ({finished}) THEN 0 ELSE 1 END), "
+        f"  SUM(CASE WHEN status IN ({finished}) THEN 0 ELSE COALESCE(seconds, 0) END), "
+        "  COUNT(*), "
+        "  SUM(CASE WHEN status = 'Completed' THEN COALESCE(seconds, 0) ELSE 0 END) "
+        "FROM all_generations WHERE user_id IS NOT NULL GROUP BY user_id"))
+    db.commit()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["rebuild"]:
+        sys.exit("usage: python -m backend.usage rebuild")
+    models.Base.metadata.create_all(bind=database.engine)
+    db = database.SessionLocal()
+    try:
+        rebuild(db)
+        print(f"Rebuilt usage for {db.query(models.UserUsage).count()} users")
+    finally:
+        db.close()
@@ -2,7 +2,10 @@ import os
 import requests
 from dotenv import load_dotenv
 import re
+import json
+import time
 from .prompts import Base_prompt
+from . import upstream
 
 load_dotenv(dotenv_path=r"backend\.env")
 
@@ -22,10 +25,92 @@ SORA_KEY= os.getenv("SORA_KEY")
      "n_variants" : "1"
     }'"""
 
-RAW_ENDPOINT = SORA_ENDPOINT.split('?')[0] 
 API_VERSION = "preview"
 
-def request_video(prompt:str, size_str: str ,sec: str, image: str = None):
+
+def _capacity(value):
+    return int(value) if value not in (None, "") else None
+
+
+def load_deployments():
+    # SORA_DEPLOYMENTS is a JSON list of {"name", "endpoint", "key", "capacity", "weight"};
+    # without it the single SORA_ENDPOINT/SORA_KEY pair is used as the only deployment.
+    # capacity is optional: unset means unlimited concurrent jobs
+    raw = os.getenv("SORA_DEPLOYMENTS")
+    if not raw:
+        return [upstream.Deployment("default", SORA_ENDPOINT, SORA_KEY,
+                                    capacity=_capacity(os.getenv("SORA_CAPACITY")))]
+    deployments = []
+    for i, cfg in enumerate(json.loads(raw)):
+        deployments.append(upstream.Deployment(
+            cfg.get("name") or f"deployment-{i}",
+            cfg["endpoint"],
+            cfg["key"],
+            capacity=_capacity(cfg.get("capacity")),
+            weight=float(cfg.get("weight", 1.0)),
+        ))
+    return deployments
+
+
+pool = upstream.DeploymentPool(load_deployments())
+
+# (connect, read) timeouts so a hung upstream counts as a failure instead of pinning a thread
+REQUEST_TIMEOUT = (5, 30)
+MAX_ATTEMPTS = 3
+# responses that mean the upstream did not act on the request, so even a POST is safe to resend
+RETRYABLE_STATUS = {429, 502, 503, 504}
+
+
+def _send(deployment: upstream.Deployment, method: str, url: str, idempotent: bool = True,
+          max_attempts: int = MAX_ATTEMPTS, **kwargs):
+    """Single entry point for upstream HTTP: goes through the deployment's circuit breaker
+    and retries within the global retry budget, honoring Retry-After."""
+    upstream.retry_budget.record_request()
+    attempt = 1
+    while True:
+        try:
+            return _send_once(deployment, method, url, idempotent, **kwargs)
+        except upstream.CircuitOpenError:
+            raise
+        except upstream.UpstreamError as e:
+            if not e.retryable or attempt >= max_attempts or not upstream.retry_budget.try_spend():
+                raise
+            delay = upstream.backoff_delay(attempt, e.retry_after)
+            print(f"Upstream {method} failed ({e}), retry {attempt} in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+
+
+def _send_once(deployment: upstream.Deployment, method: str, url: str, idempotent: bool, **kwargs):
+    breaker = deployment.breaker
+    breaker.before_call()
+    started = time.monotonic()
+    try:
+        response = requests.request(method, url, timeout=REQUEST_TIMEOUT, **kwargs)
+    except requests.RequestException as e:
+        breaker.record_failure()
+        # a read timeout on a POST may still have created the job upstream
+        safe = idempotent or isinstance(e, requests.ConnectionError)
+        raise upstream.UpstreamError(f"Network error: {e}", retryable=safe) from e
+
+    if response.status_code in RETRYABLE_STATUS or response.status_code >= 500:
+        retry_after = upstream.parse_retry_after(response.headers.get("Retry-After"))
+        breaker.record_failure(retry_after)
+        raise upstream.UpstreamError(
+            f"Azure responded with {response.status_code}",
+            status_code=response.status_code,
+            retry_after=retry_after,
+            retryable=idempotent or response.status_code in RETRYABLE_STATUS,
+        )
+
+    # any other answer, including a 4xx, proves the upstream is reachable
+    breaker.record_success()
+    deployment.observe_latency(time.monotonic() - started)
+    return response
+
+
+def request_video(prompt:str, size_str: str ,sec: str, image: str = None, deployment: upstream.Deployment = None):
+    """Submit a job to `deployment` (picked by pool.acquire() when not given)."""
 
     clean_size = re.sub(r"\s*\(.*?\)", "", size_str)
     dimensions = list(map(int, clean_size.split('x')))
@@ -42,7 +127,9 @@ def request_video(prompt:str, size_str: str ,sec: str, image: str = None):
     final_prompt = f'{Base_prompt}\n\n{prompt}'
    
 
-    headers ={"api-key":SORA_KEY, "Content-Type":"application/json"}
+    if deployment is None:
+        deployment = pool.acquire()
+    headers ={"api-key":deployment.key, "Content-Type":"application/json"}
     payload = {
         "model":'sora',
         "height" : height,
@@ -59,22 +146,70 @@ def request_video(prompt:str, size_str: str ,sec: str, image: str = None):
     else:
         payload["prompt"] = final_prompt
 
-    response = requests.post(SORA_ENDPOINT,headers=headers,json=payload)
+    # no in-place retries: a retryable failure sends the job back to the queue with backoff
+    # (jobs.submit), which doesn't hold up the dispatcher like sleeping here would
+    response = _send(deployment, "POST", deployment.endpoint, idempotent=False, max_attempts=1,
+                     headers=headers, json=payload)
 
     if response.status_code in[201,202]:
         return response.json()
     else:
         print(f"DEBUG: Azure responded with {response.status_code}:{response.text}")
-        raise Exception("Failed to connect")
+        raise upstream.UpstreamError(
+            f"Azure rejected the request with {response.status_code}",
+            status_code=response.status_code,
+            retryable=False,
+        )
     
-def get_generation_status(id: str):
-    poll_url = f"{RAW_ENDPOINT}/{id}?api-version={API_VERSION}"
-    headers = {"api-key": SORA_KEY}
+def get_generation_status(id: str, deployment: upstream.Deployment):
+    poll_url = f"{deployment.raw_endpoint}/{id}?api-version={API_VERSION}"
+    headers = {"api-key": deployment.key}
 
-    response = requests.get(poll_url, headers=headers)
+    response = _send(deployment, "GET", poll_url, headers=headers)
    
     data = response.json()
     
     
     
     return data
+
+
+def cancel_generation(id: str, deployment: upstream.Deployment):
+    # best effort: a deployment without a cancel API answers 404/405 and the job simply
+    # runs out upstream, but it is no longer polled or counted against the pool here
+    cancel_url = f"{deployment.raw_endpoint}/{id}?api-version={API_VERSION}"
+    try:
+        response = _send(deployment, "DELETE", cancel_url, headers={"api-key": deployment.key})
+    except upstream.UpstreamError as e:
+        print(f"Could not cancel upstream job {id}: {e}")
+        return False
+    return response.status_code in (200, 202, 204)
+
+
+def get_generation_video_url(generation_id: str, deployment: upstream.Deployment):
+
+    # FIX: Corrected video URL construction by removing '/jobs' from the endpoint
+    # Previously was creating invalid URLs like .../jobs/video/generations/...
+    # Now creates proper URLs: .../openai/v1/video/generations/{id}/content/video
+
+    url = f"{deployment.base_url}/{generation_id}/content/video?api-version=preview&api-key={deployment.key}"
+    return url
+
+
+def probe_deployment(deployment: upstream.Deployment):
+    # bypasses the breaker so it can observe recovery
+    try:
+        response = requests.get(deployment.endpoint, headers={"api-key": deployment.key}, timeout=REQUEST_TIMEOUT)
+    except requests.RequestException as e:
+        return {"name": deployment.name, "healthy": False, "detail": f"Network error: {e}"}
+    healthy = response.status_code < 500 and response.status_code != 429
+    return {"name": deployment.name, "healthy": healthy, "status_code": response.status_code}
+
+
+def probe_health():
+    # replaces the old backend/test.py check; ready while at least one deployment answers
+    deployments = [probe_deployment(d) for d in pool.deployments.values()]
+    return {"healthy": any(d["healthy"] for d in deployments), "deployments": deployments}
+
+
+health = upstream.HealthCache(probe_health)
@@ -1,5 +1,6 @@
 from sqlalchemy.orm import Session
-from . import models,schemas,auth
+from typing import Optional
+from . import models,schemas,auth,email
 
 
 
@@ -7,16 +8,45 @@ def get_user_by_email(db: Session, email: str):
     return db.query(models.User).filter(models.User.email == email).first()
 
 
-def create_user(db: Session, user: schemas.UserCreate):
+def get_user_by_verification_token(db: Session, token: str):
+    return db.query(models.User).filter(models.User.verification_token == token).first()
+
+
+def create_user(db: Session, user: schemas.UserCreate, verification_token: Optional[str] = None):
     hashed_pwd = auth.get_password_hash(user.password)
 
     db_user = models.User(
         email=user.email,
-        hashed_password = hashed_pwd
+        hashed_password = hashed_pwd,
+        verification_token = verification_token
     )
 
 
     db.add(db_user)
+    if verification_token:
+        # queued in the same transaction so a user never exists without their email
+        enqueue_email(db, email.build_verification_email(user.email, verification_token))
+    db.commit()
+    db.refresh(db_user)
+    return db_user
+
+
+def enqueue_email(db: Session, params: dict):
+    db_email = models.EmailOutbox(
+        to_email = params["to"],
+        subject = params["subject"],
+        html = params["html"]
+    )
+    db.add(db_email)
+    return db_email
+
+
+def verify_user(db: Session, token: str):
+    db_user = get_user_by_verification_token(db, token)
+    if db_user is None:
+        return None
+    db_user.is_verified = True
+    db_user.verification_token = None
     db.commit()
     db.refresh(db_user)
-    return db_user
\ No newline at end of file
+    return db_user
@@ -5,12 +5,18 @@ from dotenv import load_dotenv
 load_dotenv(dotenv_path=r"app\.env")
 resend.api_key = os.getenv("RESENDAPIKEY")
 
+EMAIL_FROM = "onboarding@resend.dev"
+VERIFY_BASE_URL = os.getenv("VERIFY_BASE_URL", "http://localhost:8000/verify")
 
-def send_verification_email(email: str, token:str):
-    params = {
-    "from": "onboarding@resend.dev",
+
+def build_verification_email(email: str, token: str):
+    return {
+    "from": EMAIL_FROM,
     "to": email,
     "subject": "Verify Your Email ",
-    "html": f"<strong>Click <a href='http://localhost:8000/verify?token={token}'>here</a> to verify your account.</strong>",
+    "html": f"<strong>Click <a href='{VERIFY_BASE_URL}?token={token}'>here</a> to verify your account.</strong>",
     }
-    resend.Emails.send(params)
+
+
+def send_email(params: dict):
+    return resend.Emails.send(params)
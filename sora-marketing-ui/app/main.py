@@ -1,8 +1,9 @@
 from fastapi import FastAPI, Depends, HTTPException
 from sqlalchemy.orm import Session
-from . import models,crud,schemas, email
+from . import models,crud,schemas, outbox
 from datetime import timedelta
-from.database import engine,SessionLocal,get_database
+from . import database
+from.database import get_database
 from fastapi.security import OAuth2PasswordRequestForm
 from . import auth
 from fastapi.middleware.cors import CORSMiddleware
@@ -16,10 +17,20 @@ origins = [
     "http://127.0.0.1:5500",  # Common for Live Server (VS Code)
 ]
 
-models.Base.metadata.create_all(bind=engine)
+database.ensure_schema()
 
 app = FastAPI()
 
+
+@app.on_event("startup")
+def start_outbox_sender():
+    outbox.sender.start()
+
+
+@app.on_event("shutdown")
+def stop_outbox_sender():
+    outbox.sender.stop()
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -37,9 +48,10 @@ def signup(user:schemas.UserCreate, db: Session = Depends(get_database)):
     if db_user:
         raise HTTPException(status_code = 400, detail = "Email already Exists")
     
-    new_user = crud.create_user(db=db, user=user)
+    # the verification email is queued in the same transaction and sent by the outbox sender
     verification_token = str(uuid.uuid4())
-    email.send_verification_email(new_user.email,verification_token)
+    new_user = crud.create_user(db=db, user=user, verification_token=verification_token)
+    outbox.sender.wake()
     return new_user
 
 @app.post("/token", response_model=schemas.Token)
@@ -62,4 +74,7 @@ def read_users_me(current_user: models.User = Depends(auth.get_current_user)):
 
 @app.get("/verify")
 def verify_user(token: str, db: Session = Depends(get_database)):
-                return {"message": "Email verified succesfully"}
\ No newline at end of file
+    db_user = crud.verify_user(db, token=token)
+    if db_user is None:
+        raise HTTPException(status_code=400, detail="Invalid verification token")
+    return {"message": "Email verified succesfully"}
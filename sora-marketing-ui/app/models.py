@@ -1,5 +1,10 @@
-from sqlalchemy import Column, Integer,String,Boolean
+from sqlalchemy import Column, Integer,String,Boolean,DateTime,Text
 from .database import Base
+import datetime
+
+
+def _utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
 
 
 class User(Base):
@@ -9,4 +14,25 @@ class User(Base):
     email = Column(String, unique=True,index=True)
     hashed_password = Column(String)
     is_active = Column(Boolean,default=True)
-    is_verified = Column(Boolean, default=False) 
\ No newline at end of file
+    is_verified = Column(Boolean, default=False) 
+    verification_token = Column(String, unique=True, index=True, nullable=True)
+
+
+class EmailOutbox(Base):
+    # emails are written here in the same transaction as the row that needs them
+    # and delivered later by the outbox sender, so requests never wait on the provider
+    __tablename__ = "email_outbox"
+
+    id = Column(Integer, primary_key=True)
+    to_email = Column(String, nullable=False)
+    subject = Column(String, nullable=False)
+    html = Column(Text, nullable=False)
+    status = Column(String, default="pending", index=True)  # pending / sending / sent / failed
+    # set while one sender owns the row, see outbox.claim_batch
+    claim_token = Column(String, nullable=True, index=True)
+    claimed_at = Column(DateTime, nullable=True)
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime, default=_utcnow, index=True)
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=_utcnow)
+    sent_at = Column(DateTime, nullable=True)
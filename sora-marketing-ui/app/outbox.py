@@ -0,0 +1,150 @@
+# background delivery of queued emails (see models.EmailOutbox)
+
+import os
+import random
+import threading
+import time
+import uuid
+import datetime
+
+from . import database, models, email
+
+
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "20"))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "2"))
+# provider-side rate limit, emails per second; enforced per process, so with N workers
+# running a sender set it to the provider's limit divided by N
+OUTBOX_RATE_PER_SEC = float(os.getenv("OUTBOX_RATE_PER_SEC", "2"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "5"))
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "900"))
+# seconds after which a row stuck in "sending" is assumed abandoned by a dead sender
+OUTBOX_CLAIM_TIMEOUT = float(os.getenv("OUTBOX_CLAIM_TIMEOUT", "600"))
+
+
+def _utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def backoff_seconds(attempts: int) -> float:
+    # exponential with full jitter so a provider outage doesn't come back as a thundering herd
+    delay = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * (2 ** (attempts - 1)))
+    return random.uniform(delay / 2, delay)
+
+
+class RateLimiter:
+    def __init__(self, rate_per_sec: float):
+        self.interval = 1.0 / rate_per_sec if rate_per_sec > 0 else 0.0
+        self._next = 0.0
+
+    def wait(self, stop: threading.Event):
+        delay = self._next - time.monotonic()
+        if delay > 0:
+            stop.wait(delay)
+        self._next = max(self._next, time.monotonic()) + self.interval
+
+
+def claim_batch(db, token: str) -> list:
+    """Mark up to OUTBOX_BATCH_SIZE due emails as ours. The conditional UPDATE is atomic,
+    so when several processes run a sender each email is claimed by exactly one of them."""
+    now = _utcnow()
+    # a sender that died mid-batch leaves rows in "sending"; hand them back after a while
+    db.query(models.EmailOutbox).filter(
+        models.EmailOutbox.status == "sending",
+        models.EmailOutbox.claimed_at < now - datetime.timedelta(seconds=OUTBOX_CLAIM_TIMEOUT)
+    ).update({"status": "pending", "claim_token": None}, synchronize_session=False)
+
+    due_ids = [row.id for row in db.query(models.EmailOutbox.id).filter(
+        models.EmailOutbox.status == "pending",
+        models.EmailOutbox.next_attempt_at <= now
+    ).order_by(models.EmailOutbox.id).limit(OUTBOX_BATCH_SIZE)]
+    if due_ids:
+        db.query(models.EmailOutbox).filter(
+            models.EmailOutbox.id.in_(due_ids),
+            models.EmailOutbox.status == "pending"
+        ).update({"status": "sending", "claim_token": token, "claimed_at": now}, synchronize_session=False)
+    db.commit()
+
+    return db.query(models.EmailOutbox).filter(
+        models.EmailOutbox.claim_token == token,
+        models.EmailOutbox.status == "sending"
+    ).order_by(models.EmailOutbox.id).all()
+
+
+def drain_once(limiter: RateLimiter, stop: threading.Event) -> int:
+    """Send one batch of due emails. Returns how many rows were claimed."""
+    db = database.SessionLocal()
+    try:
+        batch = claim_batch(db, uuid.uuid4().hex)
+
+        for row in batch:
+            if stop.is_set():
+                # not sent, give it back for the next sender
+                row.status = "pending"
+                row.claim_token = None
+                db.commit()
+                continue
+            limiter.wait(stop)
+            try:
+                email.send_email({
+                    "from": email.EMAIL_FROM,
+                    "to": row.to_email,
+                    "subject": row.subject,
+                    "html": row.html,
+                })
+                row.status = "sent"
+                row.sent_at = _utcnow()
+                row.last_error = None
+            except Exception as e:
+                row.attempts = (row.attempts or 0) + 1
+                row.last_error = str(e)[:500]
+                if row.attempts >= OUTBOX_MAX_ATTEMPTS:
+                    row.status = "failed"
+                    print(f"Outbox: giving up on email {row.id} after {row.attempts} attempts: {e}")
+                else:
+                    row.status = "pending"
+                    row.next_attempt_at = _utcnow() + datetime.timedelta(seconds=backoff_seconds(row.attempts))
+            row.claim_token = None
+            db.commit()
+        return len(batch)
+    finally:
+        db.close()
+
+
+class OutboxSender:
+    def __init__(self):
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+        self._limiter = RateLimiter(OUTBOX_RATE_PER_SEC)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="email-outbox", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5):
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def wake(self):
+        # lets a freshly committed email go out without waiting for the next poll
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                processed = drain_once(self._limiter, self._stop)
+            except Exception as e:
+                print(f"Outbox: drain error: {e}")
+                processed = 0
+            if processed < OUTBOX_BATCH_SIZE:
+                self._wake.wait(OUTBOX_POLL_SECONDS)
+                self._wake.clear()
+
+
+sender = OutboxSender()
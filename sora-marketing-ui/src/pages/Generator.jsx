@@ -106,6 +106,7 @@ export default function Generator({ onLogout, user }) {
 
         if (status === "completed") return { success: true, data: statusData };
         if (status === "failed") return { success: false, error: "Video generation failed" };
+        if (status === "cancelled") return { success: false, error: "Video generation was cancelled" };
 
         setStatusMessage(`Status: ${status || "processing"}...`);
         await new Promise((r) => setTimeout(r, 2000));
@@ -168,10 +169,9 @@ export default function Generator({ onLogout, user }) {
 
       setStatusMessage("Video ready! Downloading...");
 
-      const streamEndpoint = `http://127.0.0.1:8000/videos/${id}/stream`;
-      const videoRes = await fetch(streamEndpoint, {
-        headers: { Authorization: `Bearer ${token}` },
-      });
+      // stream_url carries its own signed token, no Authorization header needed
+      const streamEndpoint = `http://127.0.0.1:8000${pollResult.data.stream_url}`;
+      const videoRes = await fetch(streamEndpoint);
 
       if (!videoRes.ok) throw new Error(`Failed to fetch video stream (${videoRes.status})`);
 
@@ -459,10 +459,7 @@ export default function Generator({ onLogout, user }) {
 
                           if (h.streamEndpoint) {
                             try {
-                              const token = localStorage.getItem("access_token");
-                              const videoRes = await fetch(h.streamEndpoint, {
-                                headers: { Authorization: `Bearer ${token}` },
-                              });
+                              const videoRes = await fetch(h.streamEndpoint);
                               if (videoRes.ok) {
                                 const videoBlob = await videoRes.blob();
                                 const blobUrl = URL.createObjectURL(videoBlob);